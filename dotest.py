@@ -20,8 +20,27 @@ import re
 import types
 import math
 import time
+import signal
+import json
+import hashlib
+import statistics
+import threading
+import tempfile
+import shutil
+import io
+import contextlib
+import socket
+import xmlrpc.client
+import xmlrpc.server
+import concurrent.futures
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 terppath = None
+terppaths = []
 terpargs = []
 precommands = []
 
@@ -44,8 +63,8 @@ popt.add_option('--library', '--lib',
                 default='inform6lib',
                 help='Inform 6 library directory')
 popt.add_option('-i', '--interpreter', '--terp',
-                action='store', dest='terppath',
-                help='interpreter to execute')
+                action='append', dest='terppath',
+                help='interpreter to execute (may be repeated with --bench)')
 popt.add_option('-l', '--list',
                 action='store_true', dest='listonly',
                 help='list all tests (or all matching tests)')
@@ -62,6 +81,69 @@ popt.add_option('-t', '--timeout',
                 action='callback', callback=timeout_option_cb,
                 dest='timeout_secs', type='float', default=1.0,
                 help='timeout interval (default: 1.0 secs)')
+popt.add_option('--reduce',
+                action='store_true', dest='reduce',
+                help='shrink each failing test to a minimal failing command sequence')
+popt.add_option('-j', '--jobs',
+                action='store', dest='jobs', type='int', default=0,
+                help='number of interpreter processes to run at once, when reducing or mutating (default: one per CPU)')
+popt.add_option('--compile-jobs',
+                action='store', dest='compilejobs', type='int', default=0,
+                help='number of background compiles to run at once (default: one fewer than the number of CPUs)')
+popt.add_option('--stats',
+                action='store', dest='statsfile',
+                help='record compiler statistics in this file, and report growth')
+popt.add_option('--stats-threshold',
+                action='store', dest='statsthreshold', type='float', default=5.0,
+                help='report statistics which grow by more than this percentage (default: 5)')
+popt.add_option('--reuse',
+                action='store_true', dest='reuse',
+                help='keep one interpreter running for all the tests in a file, using RESTART between tests')
+popt.add_option('--bench',
+                action='store_true', dest='bench',
+                help='time every test under each of the --terp interpreters, and compare')
+popt.add_option('--bench-report',
+                action='store', dest='benchreport',
+                help='write the --bench results to this file (JSON)')
+popt.add_option('--budget-runs',
+                action='store', dest='budgetruns', type='int', default=3,
+                help='when a command goes over its time budget, judge it by the median of this many runs (default: 3)')
+popt.add_option('--cpu-limit',
+                action='store', dest='cpulimit', type='float',
+                help='limit each test\'s interpreter to this much CPU time (secs)')
+popt.add_option('--mem-limit',
+                action='store', dest='memlimit', type='float',
+                help='limit each interpreter\'s address space to this size (MB)')
+popt.add_option('--output-limit',
+                action='store', dest='outputlimit', type='int',
+                help='limit each test\'s total interpreter output to this many bytes')
+popt.add_option('--deadline',
+                action='store', dest='deadline', type='float',
+                help='limit each test to this much wall-clock time (secs)')
+popt.add_option('--serve',
+                action='store', dest='serve', metavar='[HOST:]PORT',
+                help='compile the tests and hand them out to --worker processes')
+popt.add_option('--worker',
+                action='store', dest='worker', metavar='HOST:PORT',
+                help='run tests handed out by a --serve process')
+popt.add_option('--lease',
+                action='store', dest='lease', type='float', default=30.0,
+                help='with --serve, retry a worker\'s tests if it is silent this long (default: 30 secs)')
+popt.add_option('--mutate',
+                action='store_true', dest='mutate',
+                help='mutation-test the library against the tests')
+popt.add_option('--mutate-files',
+                action='store', dest='mutatefiles', default='parser*.h,verblib*.h',
+                help='library files to mutate (comma-separated patterns; default: parser*.h,verblib*.h)')
+popt.add_option('--mutate-limit',
+                action='store', dest='mutatelimit', type='int', default=0,
+                help='try at most this many mutants, spread over the library')
+popt.add_option('--scratch',
+                action='store', dest='scratchdir',
+                help='directory for each interpreter\'s scratch directory (default: /dev/shm if available)')
+popt.add_option('--keep-scratch',
+                action='store_true', dest='keepscratch',
+                help='keep the scratch directories of failed tests')
 popt.add_option('--vital',
                 action='store_true', dest='vital',
                 help='abort a test on the first error')
@@ -71,7 +153,7 @@ popt.add_option('-v', '--verbose',
 
 (opts, args) = popt.parse_args()
 
-if (not args):
+if (not args and not opts.worker):
     print('usage: dotest.py [options] TESTFILES...')
     sys.exit(1)
 
@@ -82,11 +164,13 @@ class RegTest:
     A test is one session of the game, from the beginning. (Not necessarily
     to the end.) After every game command, tests can be run.
     """
-    def __init__(self, name):
+    def __init__(self, name, testfile=None):
         self.name = name
+        self.testfile = testfile
         self.gamefile = None   # use global gamefile
         self.terp = None       # global terppath, terpargs
         self.precmd = None
+        self.budget = {}       # default time budget for each command
         self.cmds = []
     def __repr__(self):
         return '<RegTest %s>' % (self.name,)
@@ -121,10 +205,10 @@ class Command:
             elif cmd.lower() in Command.glk_key_names:
                 self.cmd = cmd.lower()
             elif cmd.lower().startswith('0x'):
-                self.cmd = unichr(int(cmd[2:], 16))
+                self.cmd = chr(int(cmd[2:], 16))
             else:
                 try:
-                    self.cmd = unichr(int(cmd))
+                    self.cmd = chr(int(cmd))
                 except:
                     pass
             if self.cmd is None:
@@ -148,11 +232,24 @@ class Command:
         self.checks = []
     def __repr__(self):
         return '<Command "%s">' % (self.cmd,)
+    def sourceline(self):
+        # Return a test-file line which would produce this command.
+        if self.type == 'line':
+            return '> ' + self.cmd
+        val = self.cmd
+        if val is None or val == '\n':
+            val = ''
+        elif self.type == 'char' and len(val) == 1 and (val.isspace() or not val.isprintable()):
+            # The parser strips whitespace, so give these as codes.
+            val = '0x%02x' % (ord(val),)
+        return ('>{%s} %s' % (self.type, val,)).rstrip()
     def addcheck(self, ln):
+        source = ln
         args = {}
+        budget = {}
         # First peel off "!" and "{...}" prefixes
         while True:
-            match = re.match('!|{[a-z]*}', ln)
+            match = re.match('!|{[a-z]*}|{(maxms|maxcpu)=([0-9]+)}', ln)
             if not match:
                 break
             ln = ln[match.end() : ].strip()
@@ -163,18 +260,45 @@ class Command:
                 args['instatus'] = True
             elif val == '{vital}':
                 args['vital'] = True
+            elif match.group(1):
+                budget[match.group(1)] = int(match.group(2))
             else:
                 raise Exception('Unknown test modifier: %s' % (val,))
+        # A time budget applies to the command, not to any particular
+        # output, so it gets a Check of its own. The line may have no
+        # output test at all; then there's nothing for the other
+        # modifiers to apply to.
+        if budget:
+            if not ln:
+                if args:
+                    raise Exception('Unknown test modifier with a budget: %s' % (source,))
+                self.setbudget(budget)
+                return
+            self.setbudget(budget)
         # Then the test itself, which may have many formats. We try
         # each of the classes in the checkclasses array until one
         # returns a Check.
         for cla in checkclasses:
             check = cla.buildcheck(ln, args)
             if check is not None:
+                check.source = source
                 self.checks.append(check)
                 break
         else:
             raise Exception('Unrecognized test: %s' % (ln,))
+    def setbudget(self, budget, default=False):
+        # Add a BudgetCheck, or merge into the existing one. A default
+        # budget doesn't override limits which are already set.
+        for check in self.checks:
+            if isinstance(check, BudgetCheck):
+                for (key, val) in budget.items():
+                    if not (default and key in check.budget):
+                        check.budget[key] = val
+                break
+        else:
+            check = BudgetCheck('', budget=dict(budget))
+            self.checks.append(check)
+        check.source = check.budgetline()
 
 class Check:
     """Represents a single test (applied to the output of a game command).
@@ -194,6 +318,7 @@ class Check:
     inrawdata = False
     inverse = False
     instatus = False
+    source = None
 
     @classmethod
     def buildcheck(cla, ln, args):
@@ -238,6 +363,11 @@ class Check:
             return 'inverse test should fail'
     def subeval(self, lines):
         return 'not implemented'
+    def scanline(self, text):
+        # For streaming evaluation: return how many times this check's
+        # text occurs in one line of story output, or None if this kind
+        # of check can't be judged a line at a time.
+        return None
 
 class RegExpCheck(Check):
     """A Check which looks for a regular expression match in the output.
@@ -252,6 +382,8 @@ class RegExpCheck(Check):
             if re.search(self.ln, ln):
                 return
         return 'not found'
+    def scanline(self, text):
+        return int(bool(re.search(self.ln, text)))
         
 class LiteralCheck(Check):
     """A Check which looks for a literal string match in the output.
@@ -265,6 +397,8 @@ class LiteralCheck(Check):
             if self.ln in ln:
                 return
         return 'not found'
+    def scanline(self, text):
+        return int(self.ln in text)
 
 class LiteralCountCheck(Check):
     """A Check which looks for a literal string match in the output,
@@ -280,6 +414,15 @@ class LiteralCountCheck(Check):
             return res
     def reprdetail(self):
         return '{count=%d} ' % (self.count,)
+    def scanline(self, text):
+        counter = 0
+        start = 0
+        while True:
+            pos = text.find(self.ln, start)
+            if pos < 0:
+                return counter
+            counter += 1
+            start = pos+1
     def subeval(self, lines):
         counter = 0
         for ln in lines:
@@ -319,6 +462,85 @@ class HyperlinkSpanCheck(Check):
                         return
         return 'not found'
 
+class BudgetCheck(Check):
+    """A Check on how long the command took, rather than on its output.
+    The budget is a limit in milliseconds on the round-trip time
+    ("maxms") and/or the CPU time the interpreter used ("maxcpu").
+
+    Timing is noisy, so run() evaluates these at the end of the test,
+    and judges a command which goes over budget by the median of several
+    runs. This is not in checkclasses; Command.addcheck creates it from
+    the {maxms=...} and {maxcpu=...} modifiers.
+    """
+    def __init__(self, ln, **args):
+        Check.__init__(self, ln, **args)
+        self.budget = args.get('budget', {})
+    def __repr__(self):
+        return '<BudgetCheck %s>' % (self.budgetline(),)
+    def budgetline(self):
+        return ' '.join([ '{%s=%d}' % (key, self.budget[key]) for key in sorted(self.budget) ])
+    def eval(self, state):
+        # Timings are only available in run(), which checks them itself.
+        return
+    def overbudget(self, ms, cpums):
+        # Given the timings for a command (cpums may be None if it was
+        # not measurable), return a string if it went over budget.
+        if 'maxms' in self.budget and ms > self.budget['maxms']:
+            return '%.1f ms, over the %d ms budget' % (ms, self.budget['maxms'],)
+        if 'maxcpu' in self.budget:
+            if cpums is None:
+                return 'interpreter CPU time is not available on this platform'
+            if cpums > self.budget['maxcpu']:
+                return '%.1f ms CPU, over the %d ms budget' % (cpums, self.budget['maxcpu'],)
+
+class CheckStream:
+    """CheckStream judges a command's checks line by line, as the game's
+    output arrives. (Its feed method is installed as the GameState's
+    linehandler.) A literal or regexp check is settled as soon as it has
+    matched often enough: a plain check passes, an inverse check fails.
+
+    A vital check which fails this way is reported at once, and
+    VitalCheckException is raised from inside accept_output, so the
+    interpreter can be shut down without reading the rest of its output.
+    If abortall is set, any failure is treated this way.
+
+    The finish method reports the remaining results, evaluating checks
+    which weren't settled along the way against the complete output.
+    report is called as report(check, res) for each failure.
+    """
+    def __init__(self, checks, report, abortall=False):
+        self.checks = checks
+        self.report = report
+        self.abortall = abortall
+        self.counts = {}       # check index -> occurrences so far
+        self.results = {}      # check index -> settled result
+
+    def feed(self, text):
+        for (ix, check) in enumerate(self.checks):
+            if ix in self.results or check.instatus or check.inrawdata:
+                continue
+            count = check.scanline(text)
+            if count is None:
+                continue
+            self.counts[ix] = self.counts.get(ix, 0) + count
+            if self.counts[ix] >= getattr(check, 'count', 1):
+                res = 'inverse test should fail' if check.inverse else None
+                self.results[ix] = res
+                if res and (check.vital or self.abortall):
+                    self.report(check, res)
+                    raise VitalCheckException()
+
+    def finish(self, state):
+        for (ix, check) in enumerate(self.checks):
+            if ix in self.results:
+                res = self.results[ix]
+            else:
+                res = check.eval(state)
+            if (res):
+                self.report(check, res)
+                if check.vital or self.abortall:
+                    raise VitalCheckException()
+
 # This script only supports four kinds of checks.
 checkclasses = [ RegExpCheck, LiteralCountCheck, HyperlinkSpanCheck, LiteralCheck ]
 
@@ -344,6 +566,20 @@ class GameState:
         # Lists of line data lists
         self.statuswindat = []
         self.storywindat = []
+        # Called with the text of each story window line as it arrives
+        self.linehandler = None
+        # Whether -v prints the transcript. Background runs turn this off.
+        self.echo = True
+        # Resource accounting for the current test
+        self.outputlimit = None
+        self.outputbytes = 0
+        self.deadline = None
+
+    def set_limits(self, outputlimit=None, deadline=None):
+        # Start counting output afresh. The deadline is an absolute time.
+        self.outputlimit = outputlimit
+        self.outputbytes = 0
+        self.deadline = deadline
 
     def initialize(self):
         pass
@@ -353,6 +589,10 @@ class GameState:
         
     def accept_output(self):
         raise Exception('accept_output not implemented')
+
+    def inputstate(self):
+        # Describe what kind of input the game is waiting for.
+        return None
     
 class GameStateRemGlk(GameState):
     """Wrapper for a RemGlk-based interpreter. This can in theory handle
@@ -396,6 +636,20 @@ class GameStateRemGlk(GameState):
         self.charinputwin = None
         self.specialinput = None
         self.hyperlinkinputwin = None
+
+    def stream_line(self, dat):
+        # Pass one line object, still undecoded, to the linehandler.
+        # Grid lines have a "line" number; we only want buffer text.
+        try:
+            line = json.loads(dat)
+        except ValueError:
+            return
+        if 'line' not in line:
+            self.linehandler(self.extract_text(line))
+
+    def inputstate(self):
+        return (bool(self.lineinputwin), bool(self.charinputwin),
+                bool(self.hyperlinkinputwin), self.specialinput)
         
     def perform_input(self, cmd):
         import json
@@ -433,7 +687,7 @@ class GameStateRemGlk(GameState):
                        }
         else:
             raise Exception('Rem mode does not recognize command type: %s' % (cmd.type))
-        if opts.verbose >= 2:
+        if opts.verbose >= 2 and self.echo:
             ObjPrint.pprint(update)
             print()
         cmd = json.dumps(update)
@@ -446,11 +700,22 @@ class GameStateRemGlk(GameState):
         update = None
 
         timeout_time = time.time() + opts.timeout_secs
-        timeout_secs = opts.timeout_secs
+        deadlined = False
+        if self.deadline is not None and self.deadline < timeout_time:
+            timeout_time = self.deadline
+            deadlined = True
+        timeout_secs = max(timeout_time - time.time(), 0.0)
 
         # Read until a complete JSON object comes through the pipe or we time
-        # out. We sneakily rely on the fact that RemGlk always uses dicts as
-        # the JSON object, so it always ends with "}".
+        # out. We track the JSON nesting as the bytes arrive; RemGlk always
+        # sends a dict, so the object is complete when the depth returns to
+        # zero. Objects which open at depth 5 are lines of window content
+        # (content[].text[] for buffer windows, content[].lines[] for grid
+        # windows), and are decoded right away for the linehandler.
+        instring = False
+        escaped = False
+        depth = 0
+        linestart = None
         while (select.select([self.outfile],[],[], timeout_secs)[0] != []):
             ch = self.outfile.read(1)
             if ch == b'':
@@ -459,25 +724,50 @@ class GameStateRemGlk(GameState):
                 update = json.loads(dat)
                 break
             output += ch
-            if (output[-1] == ord('}')):
-                # Test and see if we have a valid object.
-                dat = output.decode()
-                try:
-                    update = json.loads(dat)
-                    break
-                except:
-                    pass
+            self.outputbytes += 1
+            if self.outputlimit is not None and self.outputbytes > self.outputlimit:
+                raise ResourceLimitException('Output limit of %d bytes exceeded' % (self.outputlimit,))
+            val = output[-1]
+            if instring:
+                if escaped:
+                    escaped = False
+                elif val == ord('\\'):
+                    escaped = True
+                elif val == ord('"'):
+                    instring = False
+            elif val == ord('"'):
+                instring = True
+            elif val == ord('{') or val == ord('['):
+                depth += 1
+                if depth == 5 and val == ord('{'):
+                    linestart = len(output) - 1
+            elif val == ord('}') or val == ord(']'):
+                if depth == 5 and linestart is not None:
+                    if self.linehandler:
+                        self.stream_line(output[linestart:])
+                    linestart = None
+                depth -= 1
+                if depth == 0:
+                    # Test and see if we have a valid object.
+                    dat = output.decode()
+                    try:
+                        update = json.loads(dat)
+                        break
+                    except:
+                        pass
             timeout_secs = timeout_time - time.time()
             if timeout_secs <= 0.0:
                 break
 
         if not update:
+            if deadlined:
+                raise ResourceLimitException('Deadline of %g secs exceeded' % (opts.deadline,))
             raise Exception('Timed out')
 
         # Parse the update object. This is complicated. For the format,
         # see http://eblong.com/zarf/glk/glkote/docs.html
 
-        if opts.verbose >= 2:
+        if opts.verbose >= 2 and self.echo:
             ObjPrint.pprint(update)
             print()
 
@@ -519,7 +809,7 @@ class GameStateRemGlk(GameState):
                     if text:
                         for line in text:
                             dat = self.extract_text(line)
-                            if (opts.verbose == 1):
+                            if (opts.verbose == 1 and self.echo):
                                 if (dat != '>'):
                                     print(dat)
                             if line.get('append') and len(self.storywin):
@@ -699,6 +989,7 @@ def parse_testfile(filename):
 
     curtest = None
     curcmd = None
+    filebudget = {}
 
     while True:
         ln = fl.readline()
@@ -716,9 +1007,15 @@ def parse_testfile(filename):
             key = ln[:pos].strip()
             val = ln[pos+1:].strip()
             if not curtest:
-                raise Exception('Unknown option: ** ' + key)
+                # A budget before the first test applies to all of them.
+                if (key == 'budget'):
+                    filebudget.update(parse_budget(val))
+                else:
+                    raise Exception('Unknown option: ** ' + key)
             else:
-                if (key == 'game'):
+                if (key == 'budget'):
+                    curtest.budget.update(parse_budget(val))
+                elif (key == 'game'):
                     curtest.gamefile = val
                 elif (key == 'interpreter'):
                     subls = val.split()
@@ -731,7 +1028,8 @@ def parse_testfile(filename):
             ln = ln[1:].strip()
             if (ln in testmap):
                 raise Exception('Test name used twice: ' + ln)
-            curtest = RegTest(ln)
+            curtest = RegTest(ln, filename)
+            curtest.budget.update(filebudget)
             testls.append(curtest)
             testmap[curtest.name] = curtest
             curcmd = Command('(init)')
@@ -752,13 +1050,32 @@ def parse_testfile(filename):
             continue
 
         curcmd.addcheck(ln)
+        if curcmd is curtest.precmd and [ check for check in curcmd.checks if isinstance(check, BudgetCheck) ]:
+            raise Exception('Time budgets apply to commands, not the initial output, in * ' + curtest.name)
 
     fl.close()
 
     if (not testls):
         raise Exception('Source file contains no tests')
+
+    # Apply the "** budget:" defaults to every command.
+    for test in testls:
+        if test.budget:
+            for cmd in test.cmds:
+                if cmd.type != 'include':
+                    cmd.setbudget(test.budget, default=True)
     return testls
 
+def parse_budget(val):
+    # Parse the value of a "** budget:" option, such as "maxms=50 maxcpu=20".
+    budget = {}
+    for term in val.split():
+        match = re.match('(maxms|maxcpu)=([0-9]+)$', term)
+        if not match:
+            raise Exception('Unknown budget: ' + term)
+        budget[match.group(1)] = int(match.group(2))
+    return budget
+
 
 def list_commands(ls, res=None, nested=()):
     """Given a list of commands, replace any {include} commands with the
@@ -781,81 +1098,726 @@ def list_commands(ls, res=None, nested=()):
 class VitalCheckException(Exception):
     pass
 
-def run(test, gamefile):
-    """Run a single RegTest.
+def terp_args(test, gamefile):
+    """Work out the interpreter command line for a RegTest. This respects
+    the test's "** game:" and "** interpreter:" options.
     """
-    global totalerrors
-
     testgamefile = gamefile
     if (test.gamefile):
         testgamefile = test.gamefile
     testterppath, testterpargs = (terppath, terpargs)
     if (test.terp):
         testterppath, testterpargs = test.terp
-    
-    print('* ' + test.name)
-    args = [ testterppath ] + testterpargs + [ testgamefile ]
-    proc = subprocess.Popen(args,
-                            bufsize=0,
-                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return [ testterppath ] + testterpargs + [ testgamefile ]
+
+def start_terp(args):
+    """Launch an interpreter process. Return the process and a GameState
+    connected to it. The resource limits are applied to both.
 
+    The interpreter runs in a scratch directory of its own (recorded as
+    proc.scratchdir), so that files the game writes -- saves, transcripts
+    -- don't collide with those of other sessions. The last argument is
+    taken to be the game file.
+    """
+    args = list(args)
+    if os.sep in args[0]:
+        args[0] = os.path.abspath(args[0])
+    args[-1] = os.path.abspath(args[-1])
+    scratchdir = tempfile.mkdtemp(prefix='dotest-', dir=scratch_base())
+    preexec = None
+    if resource is not None and not hasattr(resource, 'prlimit'):
+        # No prlimit() on this platform, so the limits have to be set in
+        # the child. (preexec_fn is not thread-safe, so we avoid this
+        # where possible.)
+        def preexec():
+            for (res, val) in terp_rlimits():
+                resource.setrlimit(res, val)
+    try:
+        proc = subprocess.Popen(args, cwd=scratchdir,
+                                bufsize=0, preexec_fn=preexec,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except:
+        shutil.rmtree(scratchdir, ignore_errors=True)
+        raise
+    proc.scratchdir = scratchdir
     gamestate = GameStateRemGlk(proc.stdin, proc.stdout)
+    set_terp_limits(proc, gamestate)
+    return (proc, gamestate)
+
+class ResourceLimitException(Exception):
+    """An interpreter session went past one of the limits set by
+    --cpu-limit, --mem-limit, --output-limit, or --deadline. The message
+    says which.
+    """
+    pass
+
+def terp_rlimits(cpuused=0.0):
+    """Return a list of (resource, (soft, hard)) limits to apply to an
+    interpreter process which has already used cpuused seconds of CPU.
+    """
+    ls = []
+    if (opts.cpulimit):
+        # The soft limit sends SIGXCPU, which kills the interpreter. We
+        # leave the hard limit alone, so that it can be raised for the next
+        # test in a reused session.
+        soft = int(math.ceil(cpuused + opts.cpulimit))
+        ls.append((resource.RLIMIT_CPU, (soft, resource.getrlimit(resource.RLIMIT_CPU)[1])))
+    if (opts.memlimit):
+        val = int(opts.memlimit * 1024 * 1024)
+        ls.append((resource.RLIMIT_AS, (val, val)))
+    return ls
+
+def set_terp_limits(proc, gamestate):
+    """Apply the resource limits for a new test to an interpreter process
+    and its GameState. This is safe to call from several threads, since it
+    only touches the given process.
+
+    For a new process this runs just after it's launched, so there is a
+    short window in which the interpreter is starting up and loading the
+    game without the CPU and memory limits. That work is bounded: it can't
+    run the game until we send the init event. (Setting the limits in the
+    child with preexec_fn would close the window, but isn't thread-safe.)
+    """
+    if resource is not None and hasattr(resource, 'prlimit'):
+        cpuused = terp_cpu_time(proc) or 0.0
+        for (res, val) in terp_rlimits(cpuused):
+            resource.prlimit(proc.pid, res, val)
+    deadline = None
+    if (opts.deadline):
+        deadline = time.time() + opts.deadline
+    gamestate.set_limits(opts.outputlimit, deadline)
+
+def diagnose_exception(proc, ex):
+    """Given an exception from an interpreter session, see whether the
+    interpreter was killed by the CPU limit (SIGXCPU). If so, return a
+    ResourceLimitException saying so; otherwise return ex unchanged.
+
+    There's no such test for --mem-limit. Running out of address space
+    just makes allocations fail, and the interpreter then exits however
+    it likes, which we can't tell apart from any other failure.
+    """
+    if isinstance(ex, ResourceLimitException):
+        return ex
+    if not opts.cpulimit:
+        return ex
+    if terp_exit_signal(proc, 0.5) == signal.SIGXCPU:
+        return ResourceLimitException('CPU limit of %g secs exceeded' % (opts.cpulimit,))
+    return ex
+
+def terp_exit_signal(proc, timeout):
+    """Wait up to timeout secs for an interpreter process to exit. Return
+    the signal which killed it, or None if it exited normally, is still
+    running, or we can't tell. The process is not reaped, so stop_terp()
+    can still collect its resource usage.
+    """
+    if not hasattr(os, 'waitid'):
+        return None
+    endtime = time.time() + timeout
+    while True:
+        try:
+            res = os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+        except ChildProcessError:
+            return None
+        if res is not None:
+            if res.si_code in (os.CLD_KILLED, os.CLD_DUMPED):
+                return res.si_status
+            return None
+        if time.time() >= endtime:
+            return None
+        time.sleep(0.02)
+
+# The directory where interpreter scratch directories go, once we've
+# worked it out. (False means the system default.)
+scratchbase = None
+
+def scratch_base():
+    """Return the directory to create scratch directories in: --scratch,
+    or a memory-backed filesystem if there's one we can use, or None for
+    the system's temporary directory.
+    """
+    global scratchbase
+    if scratchbase is None:
+        scratchbase = False
+        if (opts.scratchdir):
+            scratchbase = opts.scratchdir
+        elif os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK):
+            scratchbase = '/dev/shm'
+    return scratchbase or None
+
+def clear_scratch(proc):
+    # Delete everything in an interpreter's scratch directory.
+    for name in os.listdir(proc.scratchdir):
+        path = os.path.join(proc.scratchdir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+def stop_terp(proc, keepfiles=False):
+    """Shut down an interpreter process. Return its resource usage (as
+    reported by os.wait4), or None if that isn't available.
 
+    The scratch directory is deleted, unless keepfiles is set (and there's
+    anything in it).
+    """
+    proc.stdin.close()
+    proc.stdout.close()
+    # Not proc.kill(), which would reap an interpreter that has already
+    # exited, leaving nothing for wait4 to collect.
+    if proc.returncode is None:
+        try:
+            os.kill(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    usage = None
+    if hasattr(os, 'wait4'):
+        try:
+            (pid, status, usage) = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            pass
+    proc.poll()
+    if keepfiles and os.listdir(proc.scratchdir):
+        print('(files kept in %s)' % (proc.scratchdir,))
+    else:
+        shutil.rmtree(proc.scratchdir, ignore_errors=True)
+    return usage
+
+def report_failure(check, res):
+    global totalerrors
+    totalerrors += 1
+    val = '*** ' if opts.verbose else ''
+    print('%s%s: %s' % (val, check, res))
+
+def run(test, gamefile):
+    """Run a single RegTest.
+    """
+    global totalerrors
+
+    print('* ' + test.name)
+    errorsbefore = totalerrors
+    args = terp_args(test, gamefile)
+    (proc, gamestate) = (None, None)
+    if (opts.reuse):
+        (proc, gamestate) = restart_session(test, args)
+    fresh = (proc is None)
+    if fresh:
+        (proc, gamestate) = start_terp(args)
 
     cmdlist = list_commands(precommands + test.cmds)
+    reusable = False
+    timings = []
 
     try:
-        gamestate.initialize()
-        gamestate.accept_output()
-        if (test.precmd):
-            for check in test.precmd.checks:
-                res = check.eval(gamestate)
-                if (res):
-                    totalerrors += 1
-                    val = '*** ' if opts.verbose else ''
-                    print('%s%s: %s' % (val, check, res))
-                    if check.vital:
-                        raise VitalCheckException()
+        stream = CheckStream(test.precmd.checks if test.precmd else [], report_failure)
+        if fresh:
+            gamestate.linehandler = stream.feed
+            gamestate.initialize()
+            gamestate.accept_output()
+            gamestate.linehandler = None
+            initialinput = gamestate.inputstate()
+        stream.finish(gamestate)
     
-        for cmd in cmdlist:
+        for (index, cmd) in enumerate(cmdlist):
             if (opts.verbose):
                 if cmd.type == 'line':
                     # The input line is echoed by the game.
                     print('>', end='')
                 else:
                     print('> {%s} %s' % (cmd.type, repr(cmd.cmd),))
-            gamestate.perform_input(cmd)
-            gamestate.accept_output()
-            for check in cmd.checks:
-                res = check.eval(gamestate)
-                if (res):
-                    totalerrors += 1
-                    val = '*** ' if opts.verbose else ''
-                    print('%s%s: %s' % (val, check, res))
-                    if check.vital:
-                        raise VitalCheckException()
+            stream = CheckStream(cmd.checks, report_failure)
+            gamestate.linehandler = stream.feed
+            budgets = [ check for check in cmd.checks if isinstance(check, BudgetCheck) ]
+            if not budgets:
+                gamestate.perform_input(cmd)
+                gamestate.accept_output()
+            else:
+                (ms, cpums) = timed_input(proc, gamestate, cmd)
+                for check in budgets:
+                    timings.append((index, check, ms, cpums))
+            gamestate.linehandler = None
+            stream.finish(gamestate)
+        reusable = True
 
     except VitalCheckException as ex:
-        # An error has already been logged; just fall out.
-        pass
+        # An error has already been logged; just fall out. If it happened
+        # partway through the game's output, the session can't be reused.
+        reusable = (gamestate.linehandler is None)
     except Exception as ex:
+        ex = diagnose_exception(proc, ex)
         totalerrors += 1
         val = '*** ' if opts.verbose else ''
         print('%s%s: %s' % (val, ex.__class__.__name__, ex))
+    finally:
+        # This runs on KeyboardInterrupt too, so that the interpreter and
+        # its scratch directory aren't left behind.
+        failed = (totalerrors > errorsbefore)
+        if (opts.reuse and reusable and not (failed and opts.keepscratch)):
+            if not fresh:
+                initialinput = sparesession_initialinput
+            keep_session(args, proc, gamestate, initialinput)
+        else:
+            gamestate = None
+            stop_terp(proc, keepfiles=(failed and opts.keepscratch))
 
-    gamestate = None
-    proc.stdin.close()
-    proc.stdout.close()
-    proc.kill()
-    proc.poll()
+    if timings:
+        totalerrors += check_budgets(test, gamefile, cmdlist, timings)
     
+def terp_cpu_time(proc):
+    """Return the CPU time (user plus system, in seconds) which an
+    interpreter process has used so far, or None if that can't be
+    determined. This relies on the Linux /proc filesystem.
+    """
+    try:
+        with open('/proc/%d/stat' % (proc.pid,)) as fl:
+            dat = fl.read()
+        # Skip past the command name, which may contain spaces. The
+        # utime and stime fields are then the 12th and 13th.
+        fields = dat[dat.rindex(')')+1:].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except Exception:
+        return None
+
+def timed_input(proc, gamestate, cmd):
+    """Perform one command and wait for its output. Return the round-trip
+    time and the interpreter CPU time, in milliseconds. (The CPU time may
+    be None.)
+    """
+    cpustart = terp_cpu_time(proc)
+    starttime = time.time()
+    gamestate.perform_input(cmd)
+    gamestate.accept_output()
+    ms = (time.time() - starttime) * 1000.0
+    cpuend = terp_cpu_time(proc)
+    cpums = None
+    if cpustart is not None and cpuend is not None:
+        cpums = (cpuend - cpustart) * 1000.0
+    return (ms, cpums)
+
+def time_commands(test, gamefile, cmdlist, indexes):
+    """Run a list of commands silently, timing the ones at the given
+    positions. Return a dict mapping each position to (ms, cpums).
+    Positions which weren't reached (because of an exception) are left out.
+    """
+    res = {}
+    (proc, gamestate) = start_terp(terp_args(test, gamefile))
+    gamestate.echo = False
+    try:
+        gamestate.initialize()
+        gamestate.accept_output()
+        for (index, cmd) in enumerate(cmdlist):
+            if index in indexes:
+                res[index] = timed_input(proc, gamestate, cmd)
+            else:
+                gamestate.perform_input(cmd)
+                gamestate.accept_output()
+    except Exception as ex:
+        pass
+    finally:
+        gamestate = None
+        stop_terp(proc)
+    return res
+
+def check_budgets(test, gamefile, cmdlist, timings):
+    """Judge the BudgetChecks for a test, given a list of (index, check,
+    ms, cpums) timings from its run. If any command went over budget, the
+    test is run again (silently) to get --budget-runs samples, and the
+    median is judged instead. Print the failures and return the count.
+    """
+    over = [ ent for ent in timings if ent[1].overbudget(ent[2], ent[3]) ]
+    if not over:
+        return 0
+    samples = {}
+    for (index, check, ms, cpums) in timings:
+        samples[index] = [ (ms, cpums) ]
+    indexes = set([ ent[0] for ent in over ])
+    for ix in range(opts.budgetruns - 1):
+        for (index, val) in time_commands(test, gamefile, cmdlist, indexes).items():
+            samples[index].append(val)
+
+    errors = 0
+    for (index, check, ms, cpums) in over:
+        ls = samples[index]
+        medms = statistics.median([ val[0] for val in ls ])
+        cpuls = [ val[1] for val in ls if val[1] is not None ]
+        medcpu = statistics.median(cpuls) if cpuls else None
+        res = check.overbudget(medms, medcpu)
+        if (res):
+            errors += 1
+            if len(ls) > 1:
+                res += ' (median of %d runs)' % (len(ls),)
+            val = '*** ' if opts.verbose else ''
+            print('%s%s: %s: %s' % (val, check, cmdlist[index].sourceline(), res))
+    return errors
+
+# With the --reuse option, the interpreter process from the previous test
+# is kept here, along with its command line and the input state it
+# started in.
+sparesession = None
+sparesession_initialinput = None
+
+def keep_session(args, proc, gamestate, initialinput):
+    global sparesession, sparesession_initialinput
+    release_session()
+    sparesession = (args, proc, gamestate)
+    sparesession_initialinput = initialinput
+
+def release_session():
+    """Shut down the spare interpreter session, if there is one.
+    """
+    global sparesession
+    if sparesession is not None:
+        (args, proc, gamestate) = sparesession
+        sparesession = None
+        stop_terp(proc)
+
+def restart_session(test, args):
+    """Try to reuse the spare interpreter session for a new test. The game
+    is sent a RESTART command (and the confirmation); it must then be
+    waiting for the same input it was after a fresh start, and the
+    test's initial checks must pass. Return (proc, gamestate) on success.
+    On any mismatch, shut the session down and return (None, None).
+    """
+    global sparesession
+    if sparesession is None:
+        return (None, None)
+    (spareargs, proc, gamestate) = sparesession
+    sparesession = None
+    if spareargs == args:
+        try:
+            set_terp_limits(proc, gamestate)
+            clear_scratch(proc)
+            if (opts.verbose):
+                print('(restarting)')
+            if restart_game(gamestate) and gamestate.inputstate() == sparesession_initialinput:
+                checks = test.precmd.checks if test.precmd else []
+                if not [ check for check in checks if check.eval(gamestate) ]:
+                    return (proc, gamestate)
+        except Exception as ex:
+            pass
+        except BaseException:
+            # Interrupted; the session is no longer in sparesession, so
+            # shut it down here.
+            stop_terp(proc)
+            raise
+        if (opts.verbose):
+            print('(restart did not match a fresh start; launching a new interpreter)')
+    gamestate = None
+    stop_terp(proc)
+    return (None, None)
+
+def restart_game(gamestate):
+    """Send the RESTART command, and answer yes if the game asks for
+    confirmation. Return whether the game was in a state to accept it.
+    """
+    if not gamestate.lineinputwin:
+        return False
+    gamestate.perform_input(Command('restart'))
+    gamestate.accept_output()
+    if gamestate.storywin and gamestate.storywin[-1].rstrip().endswith('?'):
+        if gamestate.lineinputwin:
+            gamestate.perform_input(Command('y'))
+        elif gamestate.charinputwin:
+            gamestate.perform_input(Command('y', type='char'))
+        else:
+            return False
+        gamestate.accept_output()
+    return True
+
+
+def find_failure(test, gamefile, cmdlist, target=None):
+    """Run a list of commands silently, without logging errors or touching
+    the error count. Return (index, failure) for the first failing check,
+    where index is the position in cmdlist (-1 for the initial output) and
+    failure is the Check object. An exception is reported as a string
+    instead of a Check. If nothing fails, return (None, None).
+
+    If target is given, only that failure is looked for; other checks
+    are ignored.
+    """
+    (proc, gamestate) = start_terp(terp_args(test, gamefile))
+    gamestate.echo = False
+    index = -1
+    failures = []
+    def note(check, res):
+        failures.append(check)
+    def watch(checks):
+        # Look for failures as the output arrives, and stop at the first.
+        if target is not None:
+            checks = [ check for check in checks if check is target ]
+        stream = CheckStream(checks, note, abortall=True)
+        gamestate.linehandler = stream.feed
+        return stream
+    try:
+        stream = watch(test.precmd.checks if test.precmd else [])
+        gamestate.initialize()
+        gamestate.accept_output()
+        stream.finish(gamestate)
+        for cmd in cmdlist:
+            index += 1
+            stream = watch(cmd.checks)
+            gamestate.perform_input(cmd)
+            gamestate.accept_output()
+            stream.finish(gamestate)
+    except VitalCheckException as ex:
+        return (index, failures[0])
+    except Exception as ex:
+        ex = diagnose_exception(proc, ex)
+        return (index, '%s: %s' % (ex.__class__.__name__, ex))
+    finally:
+        gamestate = None
+        stop_terp(proc)
+    return (None, None)
+
+def reduce_test(test, gamefile):
+    """Shrink a failing RegTest to a minimal sequence of commands which
+    still produces the same failure, and print it as a new test.
+
+    This is Zeller's ddmin algorithm, working on the command list with
+    all {include} commands expanded. At each step the candidate
+    subsequences are tried in parallel, each in its own interpreter
+    process. The outcome of each candidate is remembered, so no sequence
+    is ever run twice.
+    """
+    global totalerrors
+
+    print('* ' + test.name)
+    cmdlist = list_commands(precommands + test.cmds)
+    (failpos, failure) = find_failure(test, gamefile, cmdlist)
+    if failure is None:
+        print('Test passes; nothing to reduce')
+        return
+    totalerrors += 1
+    print('%s: fails after %d of %d commands' % (failure, failpos+1, len(cmdlist),))
+
+    outcomes = {}
+    def reproduces(indexes):
+        ls = [ cmdlist[ix] for ix in indexes ]
+        if failpos >= 0:
+            ls.append(cmdlist[failpos])
+        (pos, res) = find_failure(test, gamefile, ls, target=failure)
+        return (res is not None and res == failure and pos == len(ls)-1)
+
+    jobs = opts.jobs or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        def first_reproducing(candidates):
+            # Run all the untried candidates at once, then return the
+            # first one (in the given order) which still fails.
+            untried = []
+            for cand in candidates:
+                if cand not in outcomes and cand not in untried:
+                    untried.append(cand)
+            for (cand, res) in zip(untried, pool.map(reproduces, untried)):
+                outcomes[cand] = res
+            for cand in candidates:
+                if outcomes[cand]:
+                    return cand
+            return None
+
+        current = tuple(range(max(failpos, 0)))
+        if current and first_reproducing([ () ]) is not None:
+            current = ()
+        granularity = 2
+        while len(current) >= 2:
+            size = len(current)
+            bounds = [ (size*ix) // granularity for ix in range(granularity+1) ]
+            subsets = [ current[bounds[ix]:bounds[ix+1]] for ix in range(granularity) ]
+            complements = [ current[:bounds[ix]] + current[bounds[ix+1]:] for ix in range(granularity) ]
+            cand = first_reproducing(subsets + complements)
+            if cand is not None:
+                if cand in subsets:
+                    granularity = 2
+                else:
+                    granularity = max(granularity-1, 2)
+                current = cand
+                if opts.verbose:
+                    print('...down to %d commands' % (len(current),))
+                continue
+            if granularity >= size:
+                break
+            granularity = min(granularity*2, size)
+
+    ls = [ cmdlist[ix] for ix in current ]
+    if failpos >= 0:
+        ls.append(cmdlist[failpos])
+    print('Reduced to %d commands (%d sequences tried):' % (len(ls), len(outcomes)+1,))
+    print()
+    print('* %s-reduced' % (test.name,))
+    if test.gamefile:
+        print('** game: %s' % (test.gamefile,))
+    if test.terp:
+        print('** interpreter: %s' % (' '.join([ test.terp[0] ] + test.terp[1]),))
+    if not isinstance(failure, Check):
+        print('# fails with %s' % (failure,))
+    if failpos < 0 and isinstance(failure, Check):
+        print(failure.source)
+    for cmd in ls:
+        print()
+        print(cmd.sourceline())
+    if failpos >= 0 and isinstance(failure, Check):
+        print(failure.source)
+    print()
+
+# For --bench, a map from interpreter path to the timing data collected
+# for it.
+benchdata = {}
+
+def bench_test(test, gamefile):
+    """Run a single RegTest once under each of the interpreters given on
+    the command line, timing each command and the whole session. The
+    test's "** interpreter:" option is ignored, since the point is to
+    compare interpreters.
+
+    Check failures are counted in the benchmark results, but are not
+    reported as errors. A session which ends in an exception (a timeout,
+    say) is an error. The command it was waiting on still goes into the
+    latencies, timed up to the point of failure, so that a slow
+    interpreter can't improve its percentiles by hanging.
+    """
+    global totalerrors
+    print('* ' + test.name)
+    cmdlist = list_commands(precommands + test.cmds)
+    testgamefile = test.gamefile or gamefile
+
+    for terp in terppaths:
+        dat = benchdata.setdefault(terp, {
+            'latencies':[], 'sessiontimes':[], 'maxrss':0,
+            'failures':0, 'errors':0, 'tests':{} })
+        latencies = []
+        failures = 0
+        errors = 0
+        cmdstart = None
+        starttime = time.time()
+        (proc, gamestate) = start_terp([ terp ] + terpargs + [ testgamefile ])
+        try:
+            gamestate.initialize()
+            gamestate.accept_output()
+            if (test.precmd):
+                failures += len([ check for check in test.precmd.checks if check.eval(gamestate) ])
+            for cmd in cmdlist:
+                cmdstart = time.time()
+                gamestate.perform_input(cmd)
+                gamestate.accept_output()
+                latencies.append(time.time() - cmdstart)
+                cmdstart = None
+                failures += len([ check for check in cmd.checks if check.eval(gamestate) ])
+        except Exception as ex:
+            if cmdstart is not None:
+                latencies.append(time.time() - cmdstart)
+            ex = diagnose_exception(proc, ex)
+            errors += 1
+            totalerrors += 1
+            print('%s: %s: %s' % (terp, ex.__class__.__name__, ex))
+        finally:
+            sessiontime = time.time() - starttime
+            gamestate = None
+            usage = stop_terp(proc)
+
+        maxrss = 0
+        if usage is not None:
+            maxrss = usage.ru_maxrss
+            if sys.platform == 'darwin':
+                # Reported in bytes, not kilobytes
+                maxrss = maxrss // 1024
+        dat['latencies'].extend(latencies)
+        dat['sessiontimes'].append(sessiontime)
+        dat['maxrss'] = max(dat['maxrss'], maxrss)
+        dat['failures'] += failures
+        dat['errors'] += errors
+        dat['tests'][test.testfile + ' * ' + test.name] = {
+            'sessiontime': round(sessiontime, 4),
+            'latencies': [ round(val, 4) for val in latencies ],
+            'maxrss': maxrss,
+            'failures': failures,
+            'errors': errors,
+        }
+        if (opts.verbose):
+            print('%s: %d commands in %.3f secs' % (terp, len(latencies), sessiontime,))
+
+def percentile(values, pct):
+    # Nearest-rank percentile of a list of numbers.
+    if not values:
+        return None
+    ls = sorted(values)
+    pos = int(math.ceil(pct * len(ls) / 100.0)) - 1
+    return ls[max(pos, 0)]
+
+def report_bench():
+    """Print the --bench comparison table, and write the report file if
+    one was requested.
+    """
+    report = {}
+    for terp in terppaths:
+        dat = benchdata.get(terp)
+        if not dat:
+            continue
+        latencies = dat['latencies']
+        summary = {
+            'commands': len(latencies),
+            'sessions': len(dat['sessiontimes']),
+            'sessiontime': round(sum(dat['sessiontimes']), 4),
+            'maxrss': dat['maxrss'],
+            'failures': dat['failures'],
+            'errors': dat['errors'],
+            'tests': dat['tests'],
+        }
+        for pct in (50, 95, 99):
+            val = percentile(latencies, pct)
+            if val is not None:
+                val = round(val * 1000.0, 3)
+            summary['p%d_ms' % (pct,)] = val
+        report[terp] = summary
+
+    if not report:
+        return
+    def fmtms(val):
+        return '-' if val is None else '%.2f' % (val,)
+    print()
+    print('%-24s %6s %9s %9s %9s %10s %10s %8s %6s' % ('Interpreter', 'Cmds', 'p50 ms', 'p95 ms', 'p99 ms', 'Session s', 'MaxRSS KB', 'Failures', 'Errors'))
+    for (terp, summary) in report.items():
+        print('%-24s %6d %9s %9s %9s %10.3f %10d %8d %6d' % (
+            terp, summary['commands'],
+            fmtms(summary['p50_ms']), fmtms(summary['p95_ms']), fmtms(summary['p99_ms']),
+            summary['sessiontime'], summary['maxrss'], summary['failures'],
+            summary['errors']))
+
+    if (opts.benchreport):
+        with open(opts.benchreport, 'w') as fl:
+            json.dump(report, fl, indent=1)
+            fl.write('\n')
 
 # Compile a test file with the Inform 6 compiler. Return the filename
-# of the compiled game file.
-def compile_testfile(filename, targetarg):
-    suffix = '.ulx'
-    if targetarg == '-~G':
-        suffix = '.z5'
+# of the compiled game file. If a compile job for the file was started
+# by start_compiles(), wait for that instead of compiling here.
+def compile_testfile(filename, targetarg, jobs=None):
+    print('Compiling %s...' % (filename,))
+    if jobs and filename in jobs:
+        (outname, proc, output, compiletime) = jobs[filename].result()
+    else:
+        (outname, proc, output, compiletime) = run_compiler(filename, targetarg)
+
+    # Show the compiler's messages, but not the statistics block.
+    match = re_compilestats_start.search(output)
+    if match:
+        print(output[:match.start()], end='')
+    else:
+        print(output, end='')
+    proc.check_returncode()
+
+    if (opts.statsfile):
+        stats = parse_compile_stats(output)
+        stats['storyfile'] = os.path.getsize(outname)
+        stats['compiletime'] = round(compiletime, 3)
+        record_compile_stats(filename, targetarg, stats)
+
+    return outname
+
+def run_compiler(filename, targetarg):
+    """Run the compiler on a test file, without printing anything. Return
+    the game filename, the finished process, the compiler's output, and
+    the time it took. This may be called from any thread.
+    """
+    suffix = game_suffix(targetarg)
         
     if filename.endswith('.inf'):
         outname = filename[:-4] + suffix
@@ -863,19 +1825,690 @@ def compile_testfile(filename, targetarg):
         outname = filename + suffix
         
     args = [ opts.compilerpath, targetarg ]
+    if (opts.statsfile):
+        args.append('-s')
     if (opts.librarypath):
         args.append('+'+opts.librarypath)
     args.append(filename)
     args.append(outname)
 
-    print('Compiling %s...' % (filename,))
-    subprocess.check_call(args)
+    starttime = time.time()
+    proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    compiletime = time.time() - starttime
+    output = proc.stdout.decode(errors='replace')
+    return (outname, proc, output, compiletime)
 
-    return outname
+# The pool for start_compiles(), created on first use.
+compilepool = None
+
+def start_compiles(filenames):
+    """Start compiling all the given test files in the background, so that
+    compiles overlap with each other and with running tests. Return a dict
+    mapping each filename to a Future, for compile_testfile().
+
+    The pool runs --compile-jobs compilers at a time, and takes the files
+    in the order given, which is the order in which they'll be needed. By
+    default it leaves one CPU free for the tests, whose timeouts would
+    otherwise be at the mercy of the compilers.
+    """
+    global compilepool
+    if compilepool is None:
+        jobs = opts.compilejobs or max((os.cpu_count() or 1) - 1, 1)
+        compilepool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    jobs = {}
+    for filename in filenames:
+        if filename not in jobs:
+            jobs[filename] = compilepool.submit(run_compiler, filename, targetarg)
+    return jobs
+
+def game_suffix(targetarg):
+    if targetarg == '-~G':
+        return '.z5'
+    return '.ulx'
+
+# The statistics block which the compiler prints with the -s switch
+# begins with an "In:" line.
+re_compilestats_start = re.compile('^In: +[0-9]+ source code files', re.MULTILINE)
+
+# Patterns for the statistics we keep. The compiler prints them in two
+# columns, so we search rather than matching whole lines.
+compilestats_patterns = [
+    ('objects', re.compile('([0-9]+) objects')),
+    ('classes', re.compile('([0-9]+) classes')),
+    ('commonprops', re.compile('([0-9]+) common props')),
+    ('individualprops', re.compile('([0-9]+) individual props')),
+    ('verbs', re.compile('([0-9]+) verbs')),
+    ('actions', re.compile('([0-9]+) actions')),
+    ('dictionary', re.compile('([0-9]+) dictionary entries')),
+    ('routines', re.compile('([0-9]+) routines')),
+    ('readablemem', re.compile('([0-9]+) bytes readable memory used')),
+    ('writablemem', re.compile('([0-9]+) bytes writable memory used')),
+]
+
+def parse_compile_stats(output):
+    """Pull the interesting numbers out of the compiler's statistics
+    output. Return a dict; statistics which this compiler version
+    doesn't print are left out.
+    """
+    stats = {}
+    for (key, pat) in compilestats_patterns:
+        match = pat.search(output)
+        if match:
+            stats[key] = int(match.group(1))
+    return stats
+
+def library_revision():
+    """Return a string identifying the version of the library in use.
+    This is the git revision, if the library directory is a git checkout;
+    otherwise a hash of the library files.
+    """
+    libpath = opts.librarypath
+    if not libpath or not os.path.isdir(libpath):
+        return 'unknown'
+    if os.path.exists(os.path.join(libpath, '.git')):
+        try:
+            res = subprocess.run([ 'git', '-C', libpath, 'describe', '--always', '--dirty' ],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 check=True)
+            rev = res.stdout.decode().strip()
+            if rev:
+                return rev
+        except Exception:
+            pass
+    hasher = hashlib.sha1()
+    for name in sorted(os.listdir(libpath)):
+        path = os.path.join(libpath, name)
+        if os.path.isfile(path):
+            hasher.update(name.encode())
+            with open(path, 'rb') as fl:
+                hasher.update(fl.read())
+    return 'sha1:' + hasher.hexdigest()[:12]
+
+# The statistics file is a JSON map from test filename to target to
+# library revision to a dict of statistics. It's loaded on first use.
+compilestats = None
+compilestats_revision = None
+compilestats_seen = []
+
+def record_compile_stats(filename, targetarg, stats):
+    global compilestats, compilestats_revision
+    if compilestats is None:
+        compilestats = {}
+        if os.path.exists(opts.statsfile):
+            with open(opts.statsfile) as fl:
+                compilestats = json.load(fl)
+        compilestats_revision = library_revision()
+    stats['recorded'] = time.time()
+    target = 'zcode' if targetarg == '-~G' else 'glulx'
+    revmap = compilestats.setdefault(filename, {}).setdefault(target, {})
+    revmap[compilestats_revision] = stats
+    compilestats_seen.append((filename, target))
+
+def report_compile_stats():
+    """Compare the statistics recorded in this run with the most recent
+    ones from a different library revision, and print any that grew by
+    more than the threshold. Then save the statistics file.
+    """
+    if compilestats is None:
+        return
+    flagged = []
+    for (filename, target) in compilestats_seen:
+        revmap = compilestats[filename][target]
+        current = revmap[compilestats_revision]
+        others = [ (rev, dat) for (rev, dat) in revmap.items() if rev != compilestats_revision ]
+        if not others:
+            continue
+        (baserev, base) = max(others, key=lambda pair: pair[1].get('recorded', 0))
+        for (key, val) in sorted(current.items()):
+            if key in ('recorded', 'compiletime'):
+                continue
+            oldval = base.get(key)
+            if not oldval:
+                continue
+            growth = 100.0 * (val - oldval) / oldval
+            if growth > opts.statsthreshold:
+                flagged.append('%s (%s): %s grew from %d to %d (+%.1f%% since %s)' % (filename, target, key, oldval, val, growth, baserev,))
+
+    if flagged:
+        print()
+        print('Compile statistics over the %g%% growth threshold:' % (opts.statsthreshold,))
+        for val in flagged:
+            print('  ' + val)
+
+    with open(opts.statsfile, 'w') as fl:
+        json.dump(compilestats, fl, indent=1, sort_keys=True)
+        fl.write('\n')
+
+class Mutant:
+    """Mutant represents one small change to one line of a library file,
+    for --mutate. The routine is the library routine containing the line
+    (or None, outside any routine).
+    """
+    def __init__(self, libfile, lineno, routine, start, end, old, new):
+        self.libfile = libfile
+        self.lineno = lineno
+        self.routine = routine
+        self.start = start
+        self.end = end
+        self.old = old
+        self.new = new
+        self.killedby = None
+        self.outcome = None   # 'killed', 'survived', 'equivalent', 'invalid'
+    def __repr__(self):
+        return '<Mutant %s:%d %r -> %r>' % (self.libfile, self.lineno, self.old, self.new,)
+    def describe(self):
+        return '%s:%d: %s -> %s' % (self.libfile, self.lineno, self.old, self.new.strip() or '(removed)',)
+    def apply(self, lines):
+        # Return the text of the library file with this change made.
+        ls = list(lines)
+        ln = ls[self.lineno-1]
+        ls[self.lineno-1] = ln[:self.start] + self.new + ln[self.end:]
+        return ''.join(ls)
+
+# The changes --mutate makes: flipped conditions, removed rtrue/rfalse
+# statements, and swapped constants. Each is a regexp and its replacement.
+mutation_operators = [
+    (re.compile('=='), '~='),
+    (re.compile('~='), '=='),
+    (re.compile('>='), '<'),
+    (re.compile('<='), '>'),
+    (re.compile('&&'), '||'),
+    (re.compile('\\|\\|'), '&&'),
+    (re.compile('\\brtrue;'), ';'),
+    (re.compile('\\brfalse;'), ';'),
+    (re.compile('\\btrue\\b'), 'false'),
+    (re.compile('\\bfalse\\b'), 'true'),
+    (re.compile('(?<![$\\w.])0(?![\\w.])'), '1'),
+    (re.compile('(?<![$\\w.])1(?![\\w.])'), '0'),
+]
+
+re_routine_start = re.compile('\\s*\\[\\s*([A-Za-z_][A-Za-z_0-9]*)')
+re_routine_end = re.compile('\\]\\s*;')
+re_include = re.compile('^\\s*Include\\s+"([^"]+)"', re.IGNORECASE | re.MULTILINE)
+
+def inform_code_lines(lines):
+    """Given the lines of an Inform source file, return the same lines
+    with every character that isn't code (strings, dictionary words, and
+    comments) blanked out. Double-quoted strings may span lines.
+    """
+    res = []
+    instring = False
+    for ln in lines:
+        code = []
+        insingle = False
+        comment = False
+        for ch in ln:
+            if comment:
+                code.append(' ')
+            elif instring:
+                code.append(' ')
+                if ch == '"':
+                    instring = False
+            elif insingle:
+                code.append(' ')
+                if ch == "'":
+                    insingle = False
+            elif ch == '"':
+                code.append(' ')
+                instring = True
+            elif ch == "'":
+                code.append(' ')
+                insingle = True
+            elif ch == '!':
+                code.append(' ')
+                comment = True
+            else:
+                code.append(ch)
+        res.append(''.join(code))
+    return res
+
+def generate_mutants(libfile, lines):
+    """Return a list of Mutants for one library file.
+    """
+    mutants = []
+    routine = None
+    for (ix, code) in enumerate(inform_code_lines(lines)):
+        match = re_routine_start.match(code)
+        if match:
+            routine = match.group(1)
+        for (pat, new) in mutation_operators:
+            for match in pat.finditer(code):
+                mutants.append(Mutant(libfile, ix+1, routine, match.start(), match.end(), match.group(), new))
+        if re_routine_end.search(code):
+            routine = None
+    return mutants
+
+def library_files():
+    # Map lower-cased names (with and without ".h") to the files in the
+    # library directory.
+    res = {}
+    for name in os.listdir(opts.librarypath):
+        if os.path.isfile(os.path.join(opts.librarypath, name)):
+            res[name.lower()] = name
+            if name.lower().endswith('.h'):
+                res.setdefault(name.lower()[:-2], name)
+    return res
+
+def library_dependencies(filename, libfiles, res=None):
+    """Return the set of library files which a source file includes,
+    directly or indirectly.
+    """
+    if res is None:
+        res = set()
+    with open(filename, encoding='latin-1') as fl:
+        source = fl.read()
+    for name in re_include.findall(source):
+        libfile = libfiles.get(name.lstrip('>').lower())
+        if libfile and libfile not in res:
+            res.add(libfile)
+            library_dependencies(os.path.join(opts.librarypath, libfile), libfiles, res)
+    return res
+
+def compile_quietly(filename, outname, librarypath):
+    """Compile a test file without printing anything. Raise an exception
+    if the compiler fails.
+    """
+    args = [ opts.compilerpath, targetarg, '+'+librarypath, filename, outname ]
+    proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if proc.returncode:
+        raise Exception('Compile failed: %s' % (filename,))
+
+def mutate(filenames):
+    """Mutation testing of the library. Every mutant of the library files
+    matching --mutate-files is compiled into each test file which
+    depends on it, and the tests which pass on the unmutated library are
+    run against it. A mutant is killed by its first failing check. The
+    survivors show library code which the tests don't really verify.
+
+    Mutants are tried in parallel (--jobs at a time). A mutant which
+    compiles to the same game file as the original, or as a mutant
+    already tried, isn't run again. Test files which have killed the most
+    mutants so far are tried first.
+    """
+    global testmap
+    libfiles = library_files()
+    patterns = [ pat.strip().lower() for pat in opts.mutatefiles.split(',') ]
+    targets = sorted(set([ name for name in libfiles.values()
+                           if [ pat for pat in patterns if fnmatch.fnmatch(name.lower(), pat) ] ]))
+    if not targets:
+        raise Exception('No library files match %s' % (opts.mutatefiles,))
+
+    # Baseline: compile each test file normally, and find the tests
+    # which pass. Only those are useful for killing mutants.
+    testfiles = []
+    compilejobs = start_compiles(filenames)
+    for filename in filenames:
+        try:
+            testls = parse_testfile(filename)
+            testmap = dict([(test.name, test) for test in testls])
+            gamefile = compile_testfile(filename, targetarg, compilejobs)
+            passing = []
+            for test in testls:
+                cmdlist = list_commands(precommands + test.cmds)
+                (pos, failure) = find_failure(test, gamefile, cmdlist)
+                if failure is None:
+                    passing.append((test, cmdlist))
+            testmap = None
+            with open(gamefile, 'rb') as fl:
+                gamehash = hashlib.sha1(fl.read()).hexdigest()
+            deps = library_dependencies(filename, libfiles)
+            print('%s: %d of %d tests pass' % (filename, len(passing), len(testls),))
+            if passing:
+                testfiles.append((filename, passing, deps, gamehash))
+        except Exception as ex:
+            print('EXCEPTION: %s: %s' % (filename, ex,))
+
+    mutants = []
+    sources = {}
+    for libfile in targets:
+        with open(os.path.join(opts.librarypath, libfile), encoding='latin-1', newline='') as fl:
+            sources[libfile] = fl.readlines()
+        mutants.extend(generate_mutants(libfile, sources[libfile]))
+    if opts.mutatelimit and len(mutants) > opts.mutatelimit:
+        # Spread the sample evenly over the library.
+        step = len(mutants) / opts.mutatelimit
+        mutants = [ mutants[int(ix*step)] for ix in range(opts.mutatelimit) ]
+    print('Trying %d mutants of %s...' % (len(mutants), ', '.join(targets),))
+
+    # Outcomes by (test file, game file hash): None for a game which
+    # passes all its tests, or the name of the failing test. The
+    # unmutated games are known to pass.
+    outcomes = {}
+    for (filename, passing, deps, gamehash) in testfiles:
+        outcomes[(filename, gamehash)] = None
+    # Test files which kill mutants are tried first.
+    kills = {}
+
+    def trymutant(mutant):
+        tempdir = tempfile.mkdtemp(prefix='dotest-mutant-', dir=scratch_base())
+        try:
+            libdir = os.path.join(tempdir, 'lib')
+            os.mkdir(libdir)
+            for name in os.listdir(opts.librarypath):
+                if name != mutant.libfile:
+                    os.symlink(os.path.abspath(os.path.join(opts.librarypath, name)), os.path.join(libdir, name))
+            with open(os.path.join(libdir, mutant.libfile), 'w', encoding='latin-1', newline='') as fl:
+                fl.write(mutant.apply(sources[mutant.libfile]))
+
+            dependents = [ ent for ent in testfiles if mutant.libfile in ent[2] ]
+            dependents.sort(key=lambda ent: -kills.get(ent[0], 0))
+            # A mutant is equivalent if it compiles to the same games as
+            # the unmutated library. With no dependent tests, it survives.
+            equivalent = bool(dependents)
+            for (filename, passing, deps, basehash) in dependents:
+                outname = os.path.join(tempdir, os.path.basename(filename) + game_suffix(targetarg))
+                try:
+                    compile_quietly(filename, outname, libdir)
+                except Exception:
+                    mutant.outcome = 'invalid'
+                    return
+                with open(outname, 'rb') as fl:
+                    key = (filename, hashlib.sha1(fl.read()).hexdigest())
+                if key[1] != basehash:
+                    equivalent = False
+                if key in outcomes:
+                    failed = outcomes[key]
+                else:
+                    failed = None
+                    for (test, cmdlist) in passing:
+                        (pos, failure) = find_failure(test, outname, cmdlist)
+                        if failure is not None:
+                            failed = '%s * %s' % (filename, test.name,)
+                            break
+                    outcomes[key] = failed
+                if failed:
+                    kills[filename] = kills.get(filename, 0) + 1
+                    mutant.outcome = 'killed'
+                    mutant.killedby = failed
+                    return
+            mutant.outcome = 'equivalent' if equivalent else 'survived'
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    jobs = opts.jobs or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for (mutant, res) in zip(mutants, pool.map(trymutant, mutants)):
+            if (opts.verbose):
+                print('%s: %s%s' % (mutant.describe(), mutant.outcome, (' by '+mutant.killedby) if mutant.killedby else '',))
+
+    report_mutants(mutants)
+
+def report_mutants(mutants):
+    """Print the --mutate results: a table of outcomes per library
+    routine, followed by the surviving mutants.
+    """
+    routines = {}
+    for mutant in mutants:
+        key = (mutant.libfile, mutant.routine or '(top level)')
+        routines.setdefault(key, []).append(mutant)
+    print()
+    print('%-12s %-28s %7s %7s %9s %10s %8s' % ('File', 'Routine', 'Mutants', 'Killed', 'Survived', 'Equivalent', 'Invalid'))
+    for key in sorted(routines):
+        ls = routines[key]
+        counts = [ len([ mutant for mutant in ls if mutant.outcome == outcome ])
+                   for outcome in ('killed', 'survived', 'equivalent', 'invalid') ]
+        print('%-12s %-28s %7d %7d %9d %10d %8d' % ((key[0], key[1], len(ls)) + tuple(counts)))
+
+    survivors = [ mutant for mutant in mutants if mutant.outcome == 'survived' ]
+    killed = len([ mutant for mutant in mutants if mutant.outcome == 'killed' ])
+    if survivors:
+        print()
+        print('Surviving mutants:')
+        for mutant in survivors:
+            print('  %s (in %s)' % (mutant.describe(), mutant.routine or 'top level',))
+    print()
+    print('%d mutants: %d killed, %d survived' % (len(mutants), killed, len(survivors),))
+
+class Coordinator:
+    """The --serve side of a distributed run. This holds a queue of work
+    items, one per (test file, test), and hands them out over XML-RPC to
+    any number of --worker processes. The compiled game files are sent
+    along with the test source, so workers don't need a compiler.
+
+    Workers pull items one at a time, so fast workers naturally take on
+    more of the load. A worker which stays silent for longer than the
+    lease is presumed dead, and its items go back on the queue (up to
+    maxattempts times).
+    """
+    maxattempts = 3
+
+    def __init__(self):
+        self.files = []        # (filename, source, game data, game suffix)
+        self.items = []        # (file index, test name)
+        self.pending = []      # item indexes
+        self.assigned = {}     # item index -> worker name
+        self.attempts = {}     # item index -> count
+        self.results = {}      # item index -> error count
+        self.workers = {}      # worker name -> time last heard from
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def addfile(self, filename, gamefile, testls):
+        with open(filename) as fl:
+            source = fl.read()
+        with open(gamefile, 'rb') as fl:
+            gamedata = fl.read()
+        suffix = os.path.splitext(gamefile)[1]
+        self.files.append((filename, source, gamedata, suffix))
+        for test in testls:
+            self.pending.append(len(self.items))
+            self.items.append((len(self.files)-1, test.name))
+
+    def finished(self):
+        return len(self.results) == len(self.items)
+
+    def heard(self, worker):
+        self.workers[worker] = time.time()
+
+    # The methods below are called by workers, over XML-RPC. (serve()
+    # registers exactly these.)
+
+    def hello(self, name):
+        # Return the worker's unique name, and the lease it must renew.
+        with self.lock:
+            worker = name
+            counter = 1
+            while worker in self.workers:
+                counter += 1
+                worker = '%s/%d' % (name, counter,)
+            self.heard(worker)
+            print('(worker %s connected)' % (worker,))
+            return { 'worker':worker, 'lease':opts.lease }
+
+    def heartbeat(self, worker):
+        with self.lock:
+            self.heard(worker)
+            return True
+
+    def fetch(self, worker):
+        # Return the next item, or a note to wait (everything is handed
+        # out but not finished) or stop.
+        with self.lock:
+            self.heard(worker)
+            if self.finished():
+                # This worker won't be back.
+                self.workers.pop(worker, None)
+                return { 'done':True }
+            if not self.pending:
+                return { 'wait':True }
+            index = self.pending.pop(0)
+            self.assigned[index] = worker
+            self.attempts[index] = self.attempts.get(index, 0) + 1
+            (fileindex, testname) = self.items[index]
+            return { 'item':index, 'file':fileindex, 'test':testname }
+
+    def getfile(self, worker, fileindex):
+        with self.lock:
+            self.heard(worker)
+            (filename, source, gamedata, suffix) = self.files[fileindex]
+        return { 'filename':filename, 'source':source,
+                 'game':xmlrpc.client.Binary(gamedata), 'suffix':suffix }
+
+    def report(self, worker, index, output, errors):
+        with self.lock:
+            self.heard(worker)
+            if index in self.results:
+                # A late report for an item which was already retried.
+                return False
+            # The item may have been put back on the queue, if this
+            # worker was presumed dead; the result stands anyway.
+            self.assigned.pop(index, None)
+            if index in self.pending:
+                self.pending.remove(index)
+            self.results[index] = errors
+            (fileindex, testname) = self.items[index]
+            filename = self.files[fileindex][0]
+            for ln in output.splitlines():
+                print('%s: %s' % (filename, ln,))
+            return True
+
+    def reap(self):
+        """Put the items of any worker which has gone silent back on the
+        queue, or fail them if they've been tried too often.
+        """
+        with self.lock:
+            now = time.time()
+            dead = [ worker for (worker, seen) in self.workers.items() if now - seen > opts.lease ]
+            for worker in dead:
+                del self.workers[worker]
+                print('(worker %s lost)' % (worker,))
+                for (index, owner) in list(self.assigned.items()):
+                    if owner != worker:
+                        continue
+                    del self.assigned[index]
+                    (fileindex, testname) = self.items[index]
+                    if self.attempts[index] >= self.maxattempts:
+                        filename = self.files[fileindex][0]
+                        print('%s: * %s' % (filename, testname,))
+                        print('%s: Exception: Workers died %d times running this test' % (filename, self.attempts[index],))
+                        self.results[index] = 1
+                    else:
+                        self.retried += 1
+                        self.pending.insert(0, index)
+
+def parse_address(val, defaulthost):
+    # Parse "HOST:PORT" or "PORT".
+    (host, sep, port) = val.rpartition(':')
+    return (host or defaulthost, int(port))
+
+def serve(address):
+    """Compile all the test files, and then serve them to workers until
+    every test has been run. The error total is added to totalerrors.
+    """
+    global totalerrors
+    coord = Coordinator()
+    compilejobs = start_compiles(args)
+    for arg in args:
+        try:
+            testls = parse_testfile(arg)
+            gamefile = compile_testfile(arg, targetarg, compilejobs)
+            coord.addfile(arg, gamefile, testls)
+        except Exception as ex:
+            print('EXCEPTION: %s: %s' % (arg, ex,))
+            totalerrors += 1
+
+    (host, port) = parse_address(address, 'localhost')
+    server = xmlrpc.server.SimpleXMLRPCServer((host, port), allow_none=True, logRequests=False)
+    # Only the worker calls are published. The other Coordinator methods
+    # must not be reachable over the network.
+    for func in (coord.hello, coord.heartbeat, coord.fetch, coord.getfile, coord.report):
+        server.register_function(func)
+    server.timeout = 1.0
+    print('Serving %d tests on %s:%d...' % (len(coord.items), host, port,))
+    starttime = time.time()
+    while not coord.finished():
+        server.handle_request()
+        coord.reap()
+    # Give waiting workers a chance to hear that we're done. Each one is
+    # dropped from coord.workers once it has been told.
+    endtime = time.time() + 2.0
+    while coord.workers and time.time() < endtime:
+        server.handle_request()
+    server.server_close()
+
+    errors = sum(coord.results.values())
+    totalerrors += errors
+    print()
+    print('Ran %d tests in %.1f secs, with %d errors (%d retried after losing a worker)' % (len(coord.items), time.time()-starttime, errors, coord.retried,))
+
+def work(address):
+    """Connect to a --serve process, and run tests until it says we're
+    done. The output of each test is sent back rather than printed.
+    """
+    global testmap, totalerrors
+    (host, port) = parse_address(address, 'localhost')
+    url = 'http://%s:%d/' % (host, port,)
+    proxy = xmlrpc.client.ServerProxy(url, allow_none=True)
+    dat = proxy.hello('%s:%d' % (socket.gethostname(), os.getpid(),))
+    worker = dat['worker']
+    lease = dat['lease']
+    print('Connected to %s:%d as %s' % (host, port, worker,))
+
+    # Keep our lease alive while long tests run. The coordinator decides
+    # how long the lease is. (This needs its own proxy, as they're not
+    # thread-safe.)
+    stopping = threading.Event()
+    def heartbeat():
+        beatproxy = xmlrpc.client.ServerProxy(url, allow_none=True)
+        while not stopping.wait(lease / 3.0):
+            try:
+                beatproxy.heartbeat(worker)
+            except Exception:
+                pass
+    beater = threading.Thread(target=heartbeat, daemon=True)
+    beater.start()
+
+    tempdir = tempfile.mkdtemp(prefix='dotest-')
+    files = {}   # file index -> (testmap, game file path)
+    count = 0
+    try:
+        while True:
+            try:
+                item = proxy.fetch(worker)
+            except (ConnectionError, OSError):
+                # The coordinator has finished and gone away.
+                break
+            if item.get('done'):
+                break
+            if item.get('wait'):
+                time.sleep(0.5)
+                continue
+            fileindex = item['file']
+            if fileindex not in files:
+                dat = proxy.getfile(worker, fileindex)
+                filename = os.path.join(tempdir, '%d-%s' % (fileindex, os.path.basename(dat['filename']),))
+                with open(filename, 'w') as fl:
+                    fl.write(dat['source'])
+                gamefile = os.path.splitext(filename)[0] + dat['suffix']
+                with open(gamefile, 'wb') as fl:
+                    fl.write(dat['game'].data)
+                testls = parse_testfile(filename)
+                files[fileindex] = (dict([(test.name, test) for test in testls]), gamefile)
+            (testmap, gamefile) = files[fileindex]
+            test = testmap[item['test']]
+            buf = io.StringIO()
+            before = totalerrors
+            with contextlib.redirect_stdout(buf):
+                try:
+                    run(test, gamefile)
+                except Exception as ex:
+                    totalerrors += 1
+                    print('EXCEPTION: %s' % (ex,))
+            proxy.report(worker, item['item'], buf.getvalue(), totalerrors - before)
+            count += 1
+    finally:
+        stopping.set()
+        release_session()
+        shutil.rmtree(tempdir, ignore_errors=True)
+    print('Ran %d tests' % (count,))
 
 if (opts.terppath):
-    terppath = opts.terppath
-if (not terppath):
+    terppaths = list(dict.fromkeys(opts.terppath))
+    terppath = terppaths[0]
+if (len(terppaths) > 1 and not opts.bench):
+    print('Multiple interpreters can only be given with --bench')
+    sys.exit(-1)
+if (not terppath and not opts.serve):
     print('No interpreter path specified')
     sys.exit(-1)
 
@@ -889,17 +2522,50 @@ if opts.zcodemode:
 # includes.
 testmap = None
 
-for arg in args:
-    try:
-        testls = parse_testfile(arg)
-        testmap = dict([(test.name, test) for test in testls])
-        gamefile = compile_testfile(arg, targetarg)
-        for test in testls:
-            run(test, gamefile)
-        testmap = None
-    except Exception as ex:
-        print('EXCEPTION: %s: %s' % (arg, ex,))
-        totalerrors += 1
+if opts.worker:
+    work(opts.worker)
+    sys.exit(0)
+
+if opts.serve:
+    serve(opts.serve)
+    args = []
+
+if opts.mutate:
+    mutate(args)
+    args = []
+
+# Compiles run in the background, while tests run on the files which are
+# already compiled.
+compilejobs = start_compiles(args)
+
+try:
+    for arg in args:
+        try:
+            testls = parse_testfile(arg)
+            testmap = dict([(test.name, test) for test in testls])
+            gamefile = compile_testfile(arg, targetarg, compilejobs)
+            for test in testls:
+                if opts.bench:
+                    bench_test(test, gamefile)
+                elif opts.reduce:
+                    reduce_test(test, gamefile)
+                else:
+                    run(test, gamefile)
+            release_session()
+            testmap = None
+        except Exception as ex:
+            release_session()
+            print('EXCEPTION: %s: %s' % (arg, ex,))
+            totalerrors += 1
+finally:
+    # On an interrupt, don't leave a --reuse session behind.
+    release_session()
+
+if compilepool is not None:
+    compilepool.shutdown()
+
+report_compile_stats()
+report_bench()
 
 if (totalerrors):
     print()